@@ -1,8 +1,15 @@
+import io
 import os
+import asyncio
 import logging
-import requests
-from datetime import datetime, timedelta
-from bs4 import BeautifulSoup
+import multiprocessing
+import time
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from urllib.parse import quote
 from telegram import Update
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from config import *
@@ -14,140 +21,290 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# E-utilities URLs with the fixed query parts filled in once
+_ESEARCH_URL_TMPL = f"{EUTILS_BASE_URL}esearch.fcgi?db=pubmed&term=%22{JOURNAL_TERM}%22%5BJournal%5D&datetype=pdat&mindate={{start}}&maxdate={{end}}&sort=pub_date&retmax={MAX_ARTICLES}&retmode=json"
+_EFETCH_URL_TMPL = f"{EUTILS_BASE_URL}efetch.fcgi?db=pubmed&id={{ids}}&rettype=medline&retmode=text"
+
+@lru_cache(maxsize=8)
+def _format_range(start: date, end: date) -> tuple[str, str]:
+    """Format and URL-encode a date range for E-utilities"""
+    return quote(start.strftime("%Y/%m/%d"), safe=''), quote(end.strftime("%Y/%m/%d"), safe='')
+
+def _iter_records(lines):
+    """Group an iterable of MEDLINE lines into records, holding one record at a time"""
+    record = None
+    for line in lines:
+        if line.startswith(b'PMID- '):
+            if record:
+                yield record
+            record = [line]
+        elif record is not None:
+            record.append(line)
+    if record:
+        yield record
+
+def _parse_entry(lines):
+    """Parse the lines (bytes) of one MEDLINE record, returning None if it is incomplete"""
+    # MEDLINE tags are fixed width: 4-character tag, '- ', value from column 6
+    pmid = lines[0][6:].strip().decode()
+    date = None
+    doi = None
+    
+    # Title/abstract text, collected line by line while the field is open
+    buffers = {b'TI': [], b'AB': []}
+    current = None
+    
+    for line in lines[1:]:  # Start from second line
+        tag = line[:6]
+        # Indented lines continue whichever field is open
+        if tag == b'      ':
+            if current:
+                buffers[current].append(line[6:].rstrip())
+            continue
+        
+        # Any new tag closes the open field
+        current = None
+        if tag == b'TI  - ' or tag == b'AB  - ':
+            current = tag[:2]
+            buffers[current].append(line[6:].rstrip())
+        elif tag == b'DP  - ':
+            date = line[6:].rstrip().decode()
+        elif tag == b'LID - ':
+            # Clean DOI by removing any extra text like [doi] or other suffixes
+            doi = line[6:].split(b' ', 1)[0].rstrip().decode()
+    
+    # Only the fields we keep are decoded
+    title = b' '.join(buffers[b'TI']).decode() or None
+    abstract = b' '.join(buffers[b'AB']).decode() or None
+    
+    if not (pmid and date and title):
+        logger.warning(f"Incomplete article data: PMID={pmid}, Date={date}, Title={title}")
+        return None
+    
+    logger.info(f"Parsed article: PMID={pmid}, Date={date}, Title={title[:50]}...")
+    return {
+        'pmid': pmid,
+        'date': date,
+        'title': title,
+        'abstract': abstract,
+        'doi': doi
+    }
+
+def parse_pubmed_response(content):
+    """Parse MEDLINE-format bytes to extract article information"""
+    articles = []
+    logger.info(f"Received MEDLINE content length: {len(content)}")
+    
+    # Read line by line instead of splitting the whole text up front
+    for record in _iter_records(io.BytesIO(content)):
+        try:
+            article = _parse_entry(record)
+        except Exception as e:
+            logger.warning(f"Error parsing article entry: {e}")
+            continue
+        if article:
+            articles.append(article)
+    
+    logger.info(f"Successfully parsed {len(articles)} articles from PubMed response")
+    return articles
+
 class PubMedBot:
     def __init__(self, token):
         self.token = token
-        self.base_url = PUBMED_BASE_URL
         
-    def get_date_range(self, custom_start=None, custom_end=None):
+        # Parsing is CPU-bound, so it runs in worker processes off the event loop.
+        # Workers start lazily after threads exist, so don't fork this process.
+        self._pool = self._new_pool()
+        
+        # Reuse one non-blocking connection pool for all PubMed requests
+        self.http = httpx.AsyncClient(
+            timeout=30,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36',
+                # MEDLINE text compresses well; httpx decodes br when brotli is installed
+                'Accept-Encoding': 'gzip, br'
+            },
+            # Limits go on the transport; the client ignores its own when a transport is given
+            transport=httpx.AsyncHTTPTransport(
+                retries=3,
+                limits=httpx.Limits(max_connections=20, max_keepalive_connections=10)
+            )
+        )
+        
+        # Parsed articles per date range: {(start, end): (fetched_at, articles)}
+        self._cache = {}
+        # Articles by PMID, filled from every fetch: {pmid: (fetched_at, article)}
+        self._pmid_index = {}
+        # Fetches currently running, by date range
+        self._in_flight = {}
+        # Background cache warm-ups, referenced until they finish
+        self._background_tasks = set()
+        
+    def get_date_range(self, custom_start: date | None = None, custom_end: date | None = None):
         """Calculate date range for the past month or custom range"""
         if custom_start and custom_end:
             # Use custom dates
-            start_date = datetime.strptime(custom_start, "%Y-%m-%d")
-            end_date = datetime.strptime(custom_end, "%Y-%m-%d")
+            start_date, end_date = custom_start, custom_end
         else:
             # Use past month
-            end_date = datetime.now()
+            end_date = date.today()
             start_date = end_date - timedelta(days=DAYS_BACK)
         
-        # Format dates for PubMed URL - use proper URL encoding
-        start_str = start_date.strftime("%Y/%m/%d").replace("/", "%2F")
-        end_str = end_date.strftime("%Y/%m/%d").replace("/", "%2F")
+        # Formatting only changes once per day, so it is memoized
+        return _format_range(start_date, end_date)
+    
+    async def shutdown(self, application: Application):
+        """Close the HTTP client and parser pool when the application shuts down"""
+        await self.http.aclose()
+        self._pool.shutdown(wait=False, cancel_futures=True)
+    
+    def _new_pool(self):
+        """Create the parser process pool"""
+        return ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("forkserver"))
+    
+    async def _parse(self, content):
+        """Parse MEDLINE bytes in the process pool"""
+        loop = asyncio.get_running_loop()
+        pool = self._pool
+        try:
+            return await loop.run_in_executor(pool, parse_pubmed_response, content)
+        except BrokenProcessPool:
+            # A dead worker breaks the pool for good; replace it (unless a
+            # concurrent call already did) and retry this parse once
+            logger.warning("Parser process pool broke, starting a new one")
+            if self._pool is pool:
+                self._pool = self._new_pool()
+                pool.shutdown(wait=False, cancel_futures=True)
         
-        return start_str, end_str
+        try:
+            return await loop.run_in_executor(self._pool, parse_pubmed_response, content)
+        except BrokenProcessPool:
+            logger.warning("Parser process pool broke again, parsing inline")
+            return parse_pubmed_response(content)
     
-    def scrape_pubmed(self, custom_start=None, custom_end=None):
+    async def scrape_pubmed(self, custom_start=None, custom_end=None):
         """Scrape PubMed for CPT Pharmacometrics & Systems Pharmacology articles"""
         start_date, end_date = self.get_date_range(custom_start, custom_end)
         
-        # Construct the PubMed URL
-        url = f"{self.base_url}?term=%22{JOURNAL_TERM}%22%5BJournal%5D&filter=dates.{start_date}-{end_date}&sort=date&format=pubmed&size={MAX_ARTICLES}"
+        # Serve repeated requests for the same range from the cache
+        key = (start_date, end_date)
+        entry = self._cache.get(key)
+        if entry and time.time() - entry[0] < CACHE_TTL:
+            return entry[1]
+        
+        # Share one fetch between concurrent requests for the same range
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch_range(start_date, end_date))
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        
+        # Shielded so one cancelled caller doesn't cancel the fetch for the others
+        return await asyncio.shield(task)
+    
+    async def _fetch_range(self, start_date, end_date):
+        """Fetch and parse articles for an encoded date range, filling the caches"""
+        # Search for matching PMIDs, newest first
+        search_url = _ESEARCH_URL_TMPL.format(start=start_date, end=end_date)
         
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-            }
-            
-            response = requests.get(url, headers=headers, timeout=30)
+            response = await self.http.get(search_url)
             response.raise_for_status()
+            pmids = response.json()['esearchresult']['idlist']
+            
+            if pmids:
+                # Fetch the MEDLINE records for those PMIDs as plain text
+                fetch_url = _EFETCH_URL_TMPL.format(ids=','.join(pmids))
+                response = await self.http.get(fetch_url)
+                response.raise_for_status()
+                articles = await self._parse(response.content)
+            else:
+                logger.warning("No search results found in response")
+                articles = []
             
-            return self.parse_pubmed_response(response.text)
+            now = time.time()
+            self._prune(now)
+            self._cache[(start_date, end_date)] = (now, articles)
+            self._index(articles, now)
+            
+            return articles
             
-        except requests.RequestException as e:
+        except (httpx.HTTPError, KeyError, ValueError) as e:
             logger.error(f"Error fetching PubMed data: {e}")
             return []
     
-    def parse_pubmed_response(self, html_content):
-        """Parse PubMed HTML response to extract article information"""
-        soup = BeautifulSoup(html_content, 'html.parser')
-        articles = []
+    def _prune(self, now):
+        """Drop cached ranges and indexed articles older than CACHE_TTL"""
+        # Keeps memory bounded when many custom ranges or PMIDs are requested
+        self._cache = {k: v for k, v in self._cache.items() if now - v[0] < CACHE_TTL}
+        self._pmid_index = {k: v for k, v in self._pmid_index.items() if now - v[0] < CACHE_TTL}
+    
+    def _index(self, articles, now):
+        """Add articles to the PMID index"""
+        for article in articles:
+            self._pmid_index[article['pmid']] = (now, article)
+    
+    def _lookup(self, pmid):
+        """Return the indexed article for a PMID, or None if missing or expired"""
+        entry = self._pmid_index.get(pmid)
+        if entry and time.time() - entry[0] < CACHE_TTL:
+            return entry[1]
+        return None
+    
+    def _warm_listing(self):
+        """Start fetching the past-month listing in the background if it isn't cached"""
+        entry = self._cache.get(self.get_date_range())
+        if entry and time.time() - entry[0] < CACHE_TTL:
+            return
         
-        # Find the pre tag containing the PubMed data
-        pre_tag = soup.find('pre', class_='search-results-chunk')
-        if not pre_tag:
-            logger.warning("No search results found in response")
-            return articles
+        task = asyncio.create_task(self.scrape_pubmed())
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+    
+    async def _fetch_single(self, pmid):
+        """Fetch one article by PMID and add it to the PMID index"""
+        if not (pmid.isascii() and pmid.isdigit()):
+            return None
         
-        content = pre_tag.get_text()
-        logger.info(f"Found pre tag with content length: {len(content)}")
+        fetch_url = _EFETCH_URL_TMPL.format(ids=pmid)
+        
+        try:
+            response = await self.http.get(fetch_url)
+            response.raise_for_status()
+        except httpx.HTTPError as e:
+            logger.error(f"Error fetching PMID {pmid}: {e}")
+            return None
         
-        # Split by PMID entries
-        entries = content.split('PMID- ')
-        logger.info(f"Found {len(entries)-1} PMID entries to parse")
+        # A single record parses faster inline than the round trip to the pool
+        articles = parse_pubmed_response(response.content)
+        now = time.time()
+        self._prune(now)
+        self._index(articles, now)
+        return self._lookup(pmid)
+    
+    def _build_chunks(self, articles, header):
+        """Format the article list as messages, 5 articles each"""
+        # Split articles into chunks to avoid Telegram's 4096 character limit
+        chunk_size = 5  # Number of articles per message
+        chunks = []
         
-        for entry in entries[1:]:  # Skip first empty entry
-            try:
-                lines = entry.strip().split('\n')
-                
-                # The first line should contain the PMID (without the 'PMID- ' prefix)
-                pmid = lines[0].strip() if lines else None
-                date = None
-                title = None
-                abstract = None
-                doi = None
-                
-                for i, line in enumerate(lines[1:], 1):  # Start from second line
-                    line = line.strip()
-                    if line.startswith('DP  - '):
-                        date = line.replace('DP  - ', '').strip()
-                    elif line.startswith('TI  - '):
-                        title = line.replace('TI  - ', '').strip()
-                        # Handle multi-line titles - continue until we hit LID
-                        title_lines = [title]
-                        for j in range(i + 1, len(lines)):
-                            next_line = lines[j]
-                            # Stop when we hit LID section
-                            if next_line.strip().startswith('LID -'):
-                                break
-                            # Continue if line starts with spaces (continuation of title)
-                            # Check for 6 or more spaces at the beginning
-                            elif next_line.startswith('      '):
-                                title_lines.append(next_line.strip())
-                            # If we hit any other section, stop
-                            elif any(next_line.strip().startswith(prefix) for prefix in ['AB  -', 'CI  -', 'FAU -', 'AU  -', 'AD  -', 'LA  -', 'PT  -', 'DEP -', 'PL  -', 'TA  -', 'JT  -', 'JID -', 'SB  -', 'MH  -', 'RN  -', 'PMC -', 'OTO -', 'OT  -', 'COIS-', 'EDAT-', 'MHDA-', 'PMCR-', 'CRDT-', 'PHST-', 'AID -', 'PST -', 'SO  -']):
-                                break
-                        title = ' '.join(title_lines)
-                    elif line.startswith('AB  - '):
-                        abstract = line.replace('AB  - ', '').strip()
-                        # Handle multi-line abstracts - continue until we hit CI
-                        abstract_lines = [abstract]
-                        for j in range(i + 1, len(lines)):
-                            next_line = lines[j]
-                            # Stop when we hit CI section
-                            if next_line.strip().startswith('CI  -'):
-                                break
-                            # Continue if line starts with spaces (continuation of abstract)
-                            # Check for 6 or more spaces at the beginning
-                            elif next_line.startswith('      '):
-                                abstract_lines.append(next_line.strip())
-                            # If we hit any other section, stop
-                            elif any(next_line.strip().startswith(prefix) for prefix in ['FAU -', 'AU  -', 'AD  -', 'LA  -', 'PT  -', 'DEP -', 'PL  -', 'TA  -', 'JT  -', 'JID -', 'SB  -', 'MH  -', 'RN  -', 'PMC -', 'OTO -', 'OT  -', 'COIS-', 'EDAT-', 'MHDA-', 'PMCR-', 'CRDT-', 'PHST-', 'AID -', 'PST -', 'SO  -']):
-                                break
-                        abstract = ' '.join(abstract_lines)
-                    elif line.startswith('LID - '):
-                        doi = line.replace('LID - ', '').strip()
-                        # Clean DOI by removing any extra text like [doi] or other suffixes
-                        if ' ' in doi:
-                            doi = doi.split(' ')[0]  # Take only the first part before any space
-                
-                if pmid and date and title:
-                    articles.append({
-                        'pmid': pmid,
-                        'date': date,
-                        'title': title,
-                        'abstract': abstract,
-                        'doi': doi
-                    })
-                    logger.info(f"Parsed article: PMID={pmid}, Date={date}, Title={title[:50]}...")
-                else:
-                    logger.warning(f"Incomplete article data: PMID={pmid}, Date={date}, Title={title}")
-                    
-            except Exception as e:
-                logger.warning(f"Error parsing article entry: {e}")
-                continue
+        for chunk_start in range(0, len(articles), chunk_size):
+            parts = [header] if chunk_start == 0 else []
+            for i, article in enumerate(articles[chunk_start:chunk_start + chunk_size], chunk_start + 1):
+                parts.append(
+                    f"{i}. PMID: {article['pmid']}\n"
+                    f"Date: {article['date']}\n"
+                    f"Title: _{article['title']}_\n"
+                    f"Abstract: /abstract {article['pmid']}\n\n"
+                )
+            chunks.append(''.join(parts))
         
-        logger.info(f"Successfully parsed {len(articles)} articles from PubMed response")
-        return articles
+        return chunks
+    
+    async def _send_chunks(self, update: Update, chunks):
+        """Send the chunks one after another so the numbered list stays in order"""
+        for chunk in chunks:
+            await update.message.reply_text(chunk, parse_mode='Markdown', disable_web_page_preview=True)
     
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle /start command"""
@@ -166,32 +323,14 @@ class PubMedBot:
         await update.message.reply_text("🔄 Fetching articles from the past month...")
         
         try:
-            articles = self.scrape_pubmed()
+            articles = await self.scrape_pubmed()
             
             if not articles:
                 await update.message.reply_text("❌ No articles found for the past month.")
                 return
             
-            # Split articles into chunks to avoid Telegram's 4096 character limit
-            chunk_size = 5  # Number of articles per message
-            total_articles = len(articles)
-            
-            for chunk_start in range(0, total_articles, chunk_size):
-                chunk_end = min(chunk_start + chunk_size, total_articles)
-                chunk_articles = articles[chunk_start:chunk_end]
-                
-                if chunk_start == 0:
-                    response = f"📚 CPT Pharmacometrics & Systems Pharmacology Articles (Past Month)\n\n"
-                else:
-                    response = ""
-                
-                for i, article in enumerate(chunk_articles, chunk_start + 1):
-                    response += f"{i}. PMID: {article['pmid']}\n"
-                    response += f"Date: {article['date']}\n"
-                    response += f"Title: _{article['title']}_\n"
-                    response += f"Abstract: /abstract {article['pmid']}\n\n"
-                
-                await update.message.reply_text(response, parse_mode='Markdown', disable_web_page_preview=True)
+            chunks = self._build_chunks(articles, f"📚 CPT Pharmacometrics & Systems Pharmacology Articles (Past Month)\n\n")
+            await self._send_chunks(update, chunks)
                 
         except Exception as e:
             logger.error(f"Error in articles command: {e}")
@@ -220,21 +359,28 @@ class PubMedBot:
             return
         
         pmid = context.args[0].strip()
+        
+        # Reject malformed PMIDs before doing any network work
+        if not (pmid.isascii() and pmid.isdigit()):
+            await update.message.reply_text(
+                f"❌ Invalid PMID: {pmid}\n"
+                "A PMID is a number, e.g. /abstract 41014576",
+                disable_web_page_preview=True
+            )
+            return
+        
         await update.message.reply_text(f"🔄 Fetching abstract for PMID {pmid}...")
         
         try:
-            # Get articles from the past month to find the specific PMID
-            articles = self.scrape_pubmed()
-            
-            # Find the article with the matching PMID
-            target_article = None
-            for article in articles:
-                if article['pmid'] == pmid:
-                    target_article = article
-                    break
+            # Use an already fetched article, or fetch just this PMID
+            target_article = self._lookup(pmid)
+            if not target_article:
+                # Warm the listing cache alongside, so later lookups are hits
+                self._warm_listing()
+                target_article = await self._fetch_single(pmid)
             
             if not target_article:
-                await update.message.reply_text(f"❌ Article with PMID {pmid} not found in recent articles.")
+                await update.message.reply_text(f"❌ Article with PMID {pmid} not found.")
                 return
             
             if not target_article.get('abstract'):
@@ -242,16 +388,20 @@ class PubMedBot:
                 return
             
             # Format the response
-            response = f"📄 **Abstract for PMID {pmid}**\n\n"
-            response += f"**Title:** _{target_article['title']}_\n\n"
-            response += f"**Date:** {target_article['date']}\n\n"
-            response += f"**Abstract:**\n{target_article['abstract']}\n\n"
-            response += f"🔗 [View on PubMed](https://pubmed.ncbi.nlm.nih.gov/{pmid}/)"
+            parts = [
+                f"📄 **Abstract for PMID {pmid}**", "",
+                f"**Title:** _{target_article['title']}_", "",
+                f"**Date:** {target_article['date']}", "",
+                "**Abstract:**", target_article['abstract'], "",
+                f"🔗 [View on PubMed](https://pubmed.ncbi.nlm.nih.gov/{pmid}/)"
+            ]
             
             # Add Wiley link if DOI is available
             if target_article.get('doi'):
                 wiley_link = f"https://ascpt.onlinelibrary.wiley.com/doi/{target_article['doi']}"
-                response += f"\n🔗 [View Full Article]({wiley_link})"
+                parts.append(f"🔗 [View Full Article]({wiley_link})")
+            
+            response = '\n'.join(parts)
             
             await update.message.reply_text(response, parse_mode='Markdown', disable_web_page_preview=True)
             
@@ -276,38 +426,20 @@ class PubMedBot:
             start_date = start_date.strip()
             end_date = end_date.strip()
             
-            # Validate date format
-            datetime.strptime(start_date, "%Y-%m-%d")
-            datetime.strptime(end_date, "%Y-%m-%d")
+            # Validate date format; the parsed dates are passed on as is
+            start_dt = datetime.strptime(start_date, "%Y-%m-%d").date()
+            end_dt = datetime.strptime(end_date, "%Y-%m-%d").date()
             
             await update.message.reply_text(f"🔄 Fetching articles from {start_date} to {end_date}...")
             
-            articles = self.scrape_pubmed(start_date, end_date)
+            articles = await self.scrape_pubmed(start_dt, end_dt)
             
             if not articles:
                 await update.message.reply_text(f"❌ No articles found for the period {start_date} to {end_date}.")
                 return
             
-            # Split articles into chunks to avoid Telegram's 4096 character limit
-            chunk_size = 5  # Number of articles per message
-            total_articles = len(articles)
-            
-            for chunk_start in range(0, total_articles, chunk_size):
-                chunk_end = min(chunk_start + chunk_size, total_articles)
-                chunk_articles = articles[chunk_start:chunk_end]
-                
-                if chunk_start == 0:
-                    response = f"📚 CPT Pharmacometrics & Systems Pharmacology Articles ({start_date} to {end_date})\n\n"
-                else:
-                    response = ""
-                
-                for i, article in enumerate(chunk_articles, chunk_start + 1):
-                    response += f"{i}. PMID: {article['pmid']}\n"
-                    response += f"Date: {article['date']}\n"
-                    response += f"Title: _{article['title']}_\n"
-                    response += f"Abstract: /abstract {article['pmid']}\n\n"
-                
-                await update.message.reply_text(response, parse_mode='Markdown', disable_web_page_preview=True)
+            chunks = self._build_chunks(articles, f"📚 CPT Pharmacometrics & Systems Pharmacology Articles ({start_date} to {end_date})\n\n")
+            await self._send_chunks(update, chunks)
                 
         except ValueError:
             await update.message.reply_text(
@@ -331,7 +463,7 @@ def main():
     bot = PubMedBot(token)
     
     # Create application
-    application = Application.builder().token(token).build()
+    application = Application.builder().token(token).post_shutdown(bot.shutdown).build()
     
     # Add command handlers
     application.add_handler(CommandHandler("start", bot.start_command))
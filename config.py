@@ -5,9 +5,11 @@ TELEGRAM_BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 
 # PubMed Configuration
 PUBMED_BASE_URL = "https://pubmed.ncbi.nlm.nih.gov/"
+EUTILS_BASE_URL = "https://eutils.ncbi.nlm.nih.gov/entrez/eutils/"
 JOURNAL_TERM = "CPT+Pharmacometrics+Syst+Pharmacol"
 DAYS_BACK = 30  # Number of days to look back for articles
 MAX_ARTICLES = 200  # Maximum number of articles to fetch
+CACHE_TTL = 600  # Seconds to keep fetched articles before refetching
 
 # Bot Messages
 WELCOME_MESSAGE = (